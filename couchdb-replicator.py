@@ -4,14 +4,125 @@ import argparse
 import datetime
 import sys
 import json
+import hashlib
+import logging
 import time
+import functools
 import requests
 import urllib.parse
 import concurrent.futures
 from argparse import RawTextHelpFormatter
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-DEFAULT_CONCURRENCY = 5
+
+DEFAULT_CONCURRENCY = 32
+ALL_DBS_PAGE_SIZE = 1000
+RETRY_STATUSES = frozenset([500, 502, 503, 504])
+
+# Shared HTTP session so that connections to the clusters are kept alive
+# and reused across replications instead of being re-established each time
+SESSION = requests.Session()
+
+LOGGER = logging.getLogger('couchdb-replicator')
+
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+
+class CouchDBError(Exception):
+    """
+    Raised when couchdb answers a request with an error
+    @params:
+        message     - Required  : what failed (Str)
+        response    - Required  : couchdb response (Dict or Str)
+        status_code - Optional  : HTTP response code (Int)
+    """
+
+    def __init__(self, message, response, status_code=None):
+        if status_code is not None:
+            message = '{} (HTTP {})'.format(message, status_code)
+        super().__init__('{}: {}'.format(message, response))
+        self.response = response
+        self.status_code = status_code
+
+
+class ReplicationError(CouchDBError):
+    """
+    Raised when couchdb reports that a replication failed
+    @params:
+        db          - Required  : db that failed to replicate
+        response    - Required  : couchdb response (Dict or Str)
+        status_code - Optional  : HTTP response code (Int)
+    """
+
+    def __init__(self, db, response, status_code=None):
+        super().__init__('Failed to replicate database {}'.format(db),
+                         response,
+                         status_code)
+        self.db = db
+
+
+def json_dumps(obj):
+    """
+    Serialize an object to JSON bytes, using orjson when available
+    @params:
+        obj         - Required  : object to serialize
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode()
+
+
+def json_loads(data):
+    """
+    Deserialize JSON bytes, using orjson when available
+    @params:
+        data        - Required  : JSON document (Bytes)
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def setup_session(concurrency=DEFAULT_CONCURRENCY):
+    """
+    Configure the shared HTTP session connection pool
+    @params:
+        concurrency - Optional  : number of simultaneous replications (Int)
+    """
+    # Retrying POST /_replicate is safe as couchdb identifies replications
+    # by their source and target, and retrying POST _replicator/_bulk_docs
+    # is safe as documents have fixed ids: a replayed write is a conflict.
+    # Error responses are only retried twice, as a 500 is also how couchdb
+    # reports real replication failures. Once retries are exhausted, the
+    # last response is returned so that couchdb's error is reported.
+    retries = Retry(total=5,
+                    status=2,
+                    backoff_factor=0.3,
+                    status_forcelist=RETRY_STATUSES,
+                    allowed_methods=frozenset(['GET', 'HEAD', 'POST']),
+                    raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=concurrency,
+                          pool_maxsize=concurrency,
+                          max_retries=retries)
+    SESSION.mount('http://', adapter)
+    SESSION.mount('https://', adapter)
+
+
+@functools.lru_cache(maxsize=None)
+def progress_bar_parts(fill, length):
+    """
+    Full and empty progress bars, sliced to draw the progress bar
+    @params:
+        fill        - Required  : bar fill character (Str)
+        length      - Required  : character length of bar (Int)
+    """
+    return fill * length, '-' * length
 
 
 def printProgressBar(iteration,
@@ -39,21 +150,83 @@ def printProgressBar(iteration,
     percent = ('{0:.' + str(decimals) + 'f}').format(
                     100 * (iteration / float(total)))
     filled_length = int(length * iteration // total)
-    bar = fill * filled_length + '-' * (length - filled_length)
+    fill_bar, empty_bar = progress_bar_parts(fill, length)
+    bar = fill_bar[:filled_length] + empty_bar[filled_length:]
     print('\r{} |{}| {}% {}'.format(prefix, bar, percent, suffix), end='\r')
     # Print New Line on Complete
     if iteration >= total:
         print(' ' * (len(prefix) + length + len(suffix) + 11), end='\r')
 
 
+def prefetch(iterable):
+    """
+    Iterate over an iterable, getting the next element in a background
+    thread while the current one is being processed
+    @params:
+        iterable    - Required  : elements to iterate over (Iterable)
+    """
+    iterator = iter(iterable)
+    end = object()
+    prefetcher = concurrent.futures.ThreadPoolExecutor(
+                        max_workers=1, thread_name_prefix='prefetch')
+    next_element = prefetcher.submit(next, iterator, end)
+    try:
+        element = next_element.result()
+        while element is not end:
+            next_element = prefetcher.submit(next, iterator, end)
+            yield element
+            element = next_element.result()
+    finally:
+        # When iteration is stopped early, do not wait for an element
+        # nobody will use
+        next_element.cancel()
+        prefetcher.shutdown(wait=False)
+
+
+def post_json(url, payload):
+    """
+    POST a JSON document using the shared HTTP session
+    @params:
+        url         - Required  : url to POST to
+        payload     - Required  : document to POST (Dict)
+    """
+    return SESSION.post(url, headers=JSON_HEADERS, data=json_dumps(payload))
+
+
+def log_response(res):
+    """
+    Log details of a request and its response, at debug level
+    @params:
+        res         - Required  : response (requests.Response)
+    """
+    if not LOGGER.isEnabledFor(logging.DEBUG):
+        return
+    if res.request.body:
+        LOGGER.debug('Request %s %s with data %s',
+                     res.request.method, res.url, res.request.body.decode())
+    else:
+        LOGGER.debug('Request %s %s', res.request.method, res.url)
+    LOGGER.debug('HTTP response code %s with data %s',
+                 res.status_code, res.text)
+
+
+def response_body(res):
+    """
+    Decoded body of a response, or its raw text when it is not JSON
+    @params:
+        res         - Required  : response (requests.Response)
+    """
+    try:
+        return json_loads(res.content)
+    except ValueError:
+        return res.text
+
+
 def do_replicate(
                 source,
                 target,
                 db,
-                continuous=False,
                 use_target=False,
-                verbose=False,
-                debug=False,
                 ):
     """
     Replicate a database between couchdb clusters
@@ -61,59 +234,273 @@ def do_replicate(
         source      - Required  : source cluster url
         target      - Required  : target cluster url
         db          - Required  : db to replicate
-        continuous  - Optional  : add continuous replication (Boolean)
         use_target  - Optional  : use target's _replicate API (Boolean)
-        verbose     - Optional  : print verbose messages (Boolean)
-        debug       - Optional  : print debug informations (Boolean)
     """
     payload = {
             'source': '{}/{}'.format(source, db),
             'target': '{}/{}'.format(target, db),
             'create_target': True
             }
-    replicate_url = '{}/_replicate'.format({False: source,
-                                            True: target}.get(use_target))
-    verbose_print(verbose, 'Starting replication of database {}'
-                           .format(db))
-    res = requests.post(replicate_url,
-                        headers=dict({'Content-Type': 'application/json'}),
-                        data=json.dumps(payload))
-    if debug:
-        print('Request POST {} with data {}'
-              .format(res.url, json.dumps(payload)))
-        print('HTTP response code {} with data {}'
-              .format(res.status_code, res.text))
-    if not res.json()['ok']:
-        print('*** Failed to replicate database {}'.format(db))
-        return
+    replicate_url = '{}/_replicate'.format(target if use_target else source)
+    LOGGER.info('Starting replication of database %s', db)
+    res = post_json(replicate_url, payload)
+    log_response(res)
+    # Errors are raised with couchdb's answer rather than with
+    # raise_for_status, whose message includes the url and its credentials
+    body = response_body(res)
+    if not res.ok:
+        raise ReplicationError(db, body, res.status_code)
+    if not isinstance(body, dict) or not body.get('ok'):
+        raise ReplicationError(db, body)
 
-    verbose_print(verbose, 'Replication of database {} successful'
-                           .format(db))
+    LOGGER.info('Replication of database %s successful', db)
 
-    if not continuous:
-        return
 
-    payload['continuous'] = True
-    verbose_print(verbose,
-                  'Setting up continuous replication of database {}'
-                  .format(db))
-    res = requests.post(
-        replicate_url,
-        headers=dict({'Content-Type': 'application/json'}),
-        data=json.dumps(payload)
-        )
-    if debug:
-        print('Request POST {} with data {}'
-              .format(res.url, json.dumps(payload)))
-        print('HTTP response code {} with data {}'
-              .format(res.status_code, res.text))
-    if not res.json()['ok']:
-        print('*** Failed to setup continuous replication of database {}'
-              .format(db))
+def replication_doc_id(source, target, db):
+    """
+    Id of the _replicator document of a database replication, derived
+    from source and target without their credentials so that it does not
+    change when passwords do
+    @params:
+        source      - Required  : source cluster url
+        target      - Required  : target cluster url
+        db          - Required  : replicated db
+    """
+    key = []
+    for url in (source, target):
+        parts = urllib.parse.urlsplit(url)
+        netloc = parts.netloc.rpartition('@')[2]
+        key.append(parts._replace(netloc=netloc).geturl())
+    key.append(db)
+    return 'couchdb-replicator-{}'.format(
+                hashlib.sha1('|'.join(key).encode()).hexdigest())
+
+
+def do_continuous_replicate(
+                source,
+                target,
+                dbs,
+                use_target=False,
+                ):
+    """
+    Setup continuous replication of databases between couchdb clusters
+    using a single _bulk_docs request on the _replicator database
+    @params:
+        source      - Required  : source cluster url
+        target      - Required  : target cluster url
+        dbs         - Required  : dbs to replicate (List)
+        use_target  - Optional  : use target's _replicator database (Boolean)
+    """
+    if not dbs:
+        return
+    doc_ids = {}
+    docs = {}
+    for db in dbs:
+        LOGGER.info('Setting up continuous replication of database %s', db)
+        doc_id = replication_doc_id(source, target, db)
+        doc_ids[doc_id] = db
+        docs[doc_id] = {
+            '_id': doc_id,
+            'source': '{}/{}'.format(source, db),
+            'target': '{}/{}'.format(target, db),
+            'create_target': True,
+            'continuous': True
+            }
+    replicator_url = '{}/_replicator'.format(target if use_target else source)
+    conflicts = save_replication_docs(replicator_url,
+                                      list(docs.values()),
+                                      doc_ids)
+    if not conflicts:
         return
-    verbose_print(verbose,
-                  'Continuous replication of database {} successfully '
-                  'setup'.format(db))
+
+    # A conflict means the replication document already exists. Update it
+    # when source or target changed, e.g. after a password change, so that
+    # replications do not keep using stale credentials
+    res = post_json('{}/_all_docs?include_docs=true'.format(replicator_url),
+                    {'keys': conflicts})
+    log_response(res)
+    if not res.ok:
+        raise ReplicationError(', '.join(doc_ids[doc_id]
+                                         for doc_id in conflicts),
+                               response_body(res),
+                               res.status_code)
+    updates = []
+    for row in json_loads(res.content)['rows']:
+        doc = docs[row['key']]
+        existing = row.get('doc')
+        if existing is None:
+            raise ReplicationError(doc_ids[row['key']], row)
+        if (existing.get('source'), existing.get('target')) == \
+                (doc['source'], doc['target']):
+            LOGGER.info('Continuous replication of database %s already '
+                        'setup', doc_ids[row['key']])
+            continue
+        LOGGER.info('Updating continuous replication of database %s',
+                    doc_ids[row['key']])
+        updates.append(dict(doc, _rev=existing['_rev']))
+    conflicts = save_replication_docs(replicator_url, updates, doc_ids)
+    if conflicts:
+        raise ReplicationError(', '.join(doc_ids[doc_id]
+                                         for doc_id in conflicts),
+                               'replication document updated concurrently')
+
+
+def save_replication_docs(replicator_url, docs, doc_ids):
+    """
+    Save replication documents with a single _bulk_docs request
+    Returns the ids of the documents that already exist (conflicts)
+    @params:
+        replicator_url  - Required  : _replicator database url
+        docs            - Required  : replication documents (List)
+        doc_ids         - Required  : replicated db of each doc id (Dict)
+    """
+    if not docs:
+        return []
+    res = post_json('{}/_bulk_docs'.format(replicator_url), {'docs': docs})
+    log_response(res)
+    if not res.ok:
+        raise ReplicationError(', '.join(doc_ids[doc['_id']]
+                                         for doc in docs),
+                               response_body(res),
+                               res.status_code)
+
+    conflicts = []
+    for result in json_loads(res.content):
+        db = doc_ids[result['id']]
+        if result.get('error') == 'conflict':
+            conflicts.append(result['id'])
+            continue
+        if 'error' in result:
+            raise ReplicationError(db, result)
+        LOGGER.info('Continuous replication of database %s successfully '
+                    'setup', db)
+    return conflicts
+
+
+def iter_all_dbs(source, page_size=ALL_DBS_PAGE_SIZE):
+    """
+    Get the list of all databases of a couchdb cluster, one page at a time
+    @params:
+        source      - Required  : cluster url
+        page_size   - Optional  : number of databases per page (Int)
+    """
+    LOGGER.info('Getting list of all databases in source')
+    params = {'limit': page_size}
+    previous_page = None
+    while True:
+        res = SESSION.get('{}/_all_dbs'.format(source), params=params)
+        log_response(res)
+        if not res.ok:
+            raise CouchDBError('Failed to get list of databases in source',
+                               response_body(res),
+                               res.status_code)
+        page = json_loads(res.content)
+        # Older couchdb versions, or proxies stripping the query string,
+        # ignore pagination and return all databases at once
+        if len(page) > page_size:
+            if previous_page is not None:
+                raise CouchDBError('Failed to get list of databases in '
+                                   'source',
+                                   'pagination of _all_dbs is not supported')
+            yield page
+            return
+        # Same when there are exactly page_size databases: the second
+        # request returns the whole list again, which was already yielded.
+        # A server honouring start_key/skip never repeats a page, and
+        # couchdb either supports all of limit/start_key/skip or none.
+        if page == previous_page:
+            return
+        if page and previous_page is not None and \
+                page[-1] <= previous_page[-1]:
+            raise CouchDBError('Failed to get list of databases in source',
+                               'pagination of _all_dbs is not supported')
+        if page:
+            yield page
+        if len(page) < page_size:
+            return
+        previous_page = page
+        # Next page starts right after the last database of this one
+        params = {'limit': page_size,
+                  'start_key': json.dumps(page[-1]),
+                  'skip': 1}
+
+
+def select_dbs(dbs, skip_db, system_dbs=False):
+    """
+    Filter out databases that should not be replicated
+    Returns the url-quoted names of the databases to replicate
+    @params:
+        dbs         - Required  : databases names (List)
+        skip_db     - Required  : databases to skip (Set)
+        system_dbs  - Optional  : do not skip system databases (Boolean)
+    """
+    selected_dbs = []
+    for db in dbs:
+        if db.startswith('_') and not system_dbs:
+            LOGGER.info('Skipping system database %s', db)
+            continue
+
+        quoted_db = urllib.parse.quote_plus(db)
+        if db in skip_db or quoted_db in skip_db:
+            LOGGER.info('Skipping database %s', db)
+            continue
+
+        selected_dbs.append(quoted_db)
+    return selected_dbs
+
+
+def cancel_replications(executor, threads):
+    """
+    Cancel replications that did not start yet and stop the thread pool
+    (same as shutdown's cancel_futures, which needs Python 3.9)
+    @params:
+        executor    - Required  : thread pool running replications
+        threads     - Required  : pending replications (Set)
+    """
+    for thread in threads:
+        thread.cancel()
+    executor.shutdown(wait=False)
+
+
+def wait_replications(
+                executor,
+                threads,
+                max_pending,
+                done,
+                total,
+                quiet=False,
+                ):
+    """
+    Wait for replications to complete until at most max_pending of them
+    are left, and show progress bar unless quiet
+    Returns the pending replications and the number of completed ones
+    @params:
+        executor    - Required  : thread pool running replications
+        threads     - Required  : pending replications (Set)
+        max_pending - Required  : number of replications left pending (Int)
+        done        - Required  : number of completed replications (Int)
+        total       - Required  : total number of replications (Int)
+        quiet       - Optional  : do not show progress bar (Boolean)
+    """
+    while len(threads) > max_pending:
+        finished, threads = concurrent.futures.wait(
+            threads,
+            return_when=concurrent.futures.FIRST_COMPLETED)
+        for thread in finished:
+            # Die as soon as a thread raised an exception
+            if thread.exception() is not None:
+                cancel_replications(executor, threads)
+                raise(thread.exception())
+            done += 1
+            if not quiet:
+                printProgressBar(
+                    done,
+                    total,
+                    prefix='Progress:',
+                    suffix='Complete',
+                    length=50
+                    )
+    return threads, done
 
 
 def parse_args(argv=sys.argv):
@@ -162,14 +549,33 @@ def parse_args(argv=sys.argv):
     optional_named.add_argument('-c',
                                 '--concurrency',
                                 help='Maximum number of simultaneous '
-                                     'replications',
+                                     'replications (default: {}).\n'
+                                     'CouchDB also limits running '
+                                     'replications per node\n'
+                                     '(replicator max_jobs)'
+                                     .format(DEFAULT_CONCURRENCY),
                                 action='store',
+                                type=int,
                                 default=DEFAULT_CONCURRENCY)
+    optional_named.add_argument('-b',
+                                '--batch_size',
+                                help='Maximum number of replications '
+                                     'queued in the thread pool\n'
+                                     'at once. A new replication is '
+                                     'queued each time one\n'
+                                     'completes. Defaults to 4 times the '
+                                     'concurrency',
+                                action='store',
+                                type=int,
+                                default=None)
     optional_named.add_argument('--use_target',
                                 help='Use the target\'s _replicate API when '
-                                     'replicating.\n'
-                                     'By default, the source\'s _replicate '
-                                     'API is used',
+                                     'replicating, and store\n'
+                                     'permanent replications (-p) in the '
+                                     'target\'s _replicator\n'
+                                     'database. By default, the source\'s '
+                                     '_replicate API\n'
+                                     'and _replicator database are used',
                                 action='store_true',
                                 default=False)
     optional_named.add_argument('--system_dbs',
@@ -180,8 +586,14 @@ def parse_args(argv=sys.argv):
                                 default=False)
     optional_named.add_argument('-p',
                                 '--permanent',
-                                help='Add permanent continuous replication '
-                                     'after first initial\nreplication',
+                                help='Setup permanent continuous replication '
+                                     'using the\n_replicator database',
+                                action='store_true',
+                                default=False)
+    optional_named.add_argument('--initial',
+                                help='With -p, make a first initial '
+                                     'replication before setting up\n'
+                                     'permanent continuous replication',
                                 action='store_true',
                                 default=False)
     optional_named.add_argument('-v',
@@ -211,89 +623,134 @@ def parse_args(argv=sys.argv):
         parser.error('Need to specify database to replicate or --all')
     if args.all and len(args.DB) != 0:
         parser.error('--all and specifying dbs are mutually exclusive')
+    if args.initial and not args.permanent:
+        parser.error('--initial can only be used with --permanent')
+    if args.concurrency < 1:
+        parser.error('--concurrency must be a positive number')
+    if args.batch_size is None:
+        args.batch_size = 4 * args.concurrency
+    elif args.batch_size < 1:
+        parser.error('--batch_size must be a positive number')
     return args
 
 
-def verbose_print(verbose=False, *args):
-    if verbose:
-        print(*args)
+def setup_logging(verbose=False, debug=False):
+    """
+    Send log messages to the standard output
+    @params:
+        verbose     - Optional  : log verbose messages (Boolean)
+        debug       - Optional  : log debug informations (Boolean)
+    """
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    LOGGER.addHandler(handler)
+    if debug:
+        LOGGER.setLevel(logging.DEBUG)
+    elif verbose:
+        LOGGER.setLevel(logging.INFO)
+    else:
+        LOGGER.setLevel(logging.WARNING)
 
 
 def main(argv=sys.argv):
     args = parse_args(argv)
 
     if args.skip:
-        skip_db = [x.strip() for x in args.skip.split(',')]
+        skip_db = {x.strip() for x in args.skip.split(',')}
     else:
-        skip_db = []
+        skip_db = frozenset()
+
+    setup_logging(verbose=args.verbose, debug=args.debug)
+    setup_session(args.concurrency)
 
     if args.all:
-        verbose_print(args.verbose, 'Getting list of all databases in source')
-        res = requests.get('{}/_all_dbs'.format(args.source))
-        if args.debug:
-            print('Request GET {}'.format(res.url))
-            print('HTTP response code {} with data {}'
-                  .format(res.status_code, res.text))
-        dbs = res.json()
+        # Get next page of databases while current one is being replicated
+        pages = prefetch(iter_all_dbs(args.source))
     else:
-        dbs = args.DB
+        pages = [args.DB]
 
     executor = concurrent.futures.ThreadPoolExecutor(
-                                 max_workers=int(args.concurrency)
+                                 max_workers=args.concurrency,
+                                 thread_name_prefix='replicate'
                                  )
-    threads = []
 
     if not args.quiet:
-        start_time = datetime.datetime.utcnow()
+        start_time = datetime.datetime.now(datetime.timezone.utc)
+        start = time.monotonic()
         print('Replication started at {}'.format(start_time))
 
-    # Add all replications as asynchronous threads in thread pool
-    for db in dbs:
-        if db.startswith('_') and not args.system_dbs:
-            verbose_print(args.verbose, 'Skipping system database {}'
-                                        .format(db))
-            continue
+    # Replicate databases one page of the databases list at a time, so that
+    # replications start as soon as the first page is received.
+    # Progress bar shows progress over the databases listed so far.
+    total = 0
+    done = 0
+    threads = set()
+    try:
+        for page in pages:
+            selected_dbs = select_dbs(page,
+                                      skip_db,
+                                      system_dbs=args.system_dbs)
+            total += len(selected_dbs)
 
-        if db in skip_db or urllib.parse.quote_plus(db) in skip_db:
-            verbose_print(args.verbose, 'Skipping database {}'.format(db))
-            continue
+            # Continuous replications catch up by themselves, only run one-shot
+            # replications before setting them up when explicitly asked to
+            if args.permanent and not args.initial:
+                oneshot_dbs = []
+            else:
+                oneshot_dbs = selected_dbs
 
-        threads.append(executor.submit(do_replicate,
-                                       args.source,
-                                       args.target,
-                                       urllib.parse.quote_plus(db),
-                                       continuous=args.permanent,
-                                       use_target=args.use_target,
-                                       verbose=args.verbose,
-                                       debug=args.debug))
-
-    # Wait for all threads to complete and show progress bar unless quiet
-    total = len(threads)
-    done_threads = []
-    while len(done_threads) < total:
-        new_threads_done = [thread for thread in threads
-                            if thread not in done_threads and thread.done()]
-        for thread in new_threads_done:
-            # Die as soon as a thread raised an exception
-            if thread.exception() is not None:
-                raise(thread.exception())
-        done_threads.extend(new_threads_done)
-        if not args.quiet:
-            printProgressBar(
-                len(done_threads),
-                total,
-                prefix='Progress:',
-                suffix='Complete',
-                length=50
-                )
-        time.sleep(1)
+            # Add replications as asynchronous threads in thread pool, keeping
+            # at most batch_size of them queued at once, and show progress bar
+            # unless quiet
+            for db in oneshot_dbs:
+                threads.add(executor.submit(do_replicate,
+                                            args.source,
+                                            args.target,
+                                            db,
+                                            use_target=args.use_target))
+                threads, done = wait_replications(executor,
+                                                  threads,
+                                                  args.batch_size - 1,
+                                                  done,
+                                                  total,
+                                                  quiet=args.quiet)
+
+            # Continuous replications of the page are all setup at once once
+            # initial replications of the page, if any, are done
+            if args.permanent:
+                threads, done = wait_replications(executor,
+                                                  threads,
+                                                  0,
+                                                  done,
+                                                  total,
+                                                  quiet=args.quiet)
+                do_continuous_replicate(args.source,
+                                        args.target,
+                                        selected_dbs,
+                                        use_target=args.use_target)
+
+        # Wait for the last replications to complete
+        threads, done = wait_replications(executor,
+                                          threads,
+                                          0,
+                                          done,
+                                          total,
+                                          quiet=args.quiet)
+    except BaseException:
+        # Do not leave queued replications running when listing databases
+        # or setting up continuous replications failed
+        cancel_replications(executor, threads)
+        raise
+    finally:
+        if args.all:
+            pages.close()
 
     if not args.quiet:
-        end_time = datetime.datetime.utcnow()
+        end_time = datetime.datetime.now(datetime.timezone.utc)
         print('Replication ended at {}'.format(end_time))
-        elapsed = end_time - start_time
+        elapsed = datetime.timedelta(seconds=time.monotonic() - start)
         print('Replication of {} databases took {}'
-              .format(len(threads), elapsed))
+              .format(total, elapsed))
 
 
 if __name__ == '__main__':